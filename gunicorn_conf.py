@@ -0,0 +1,15 @@
+import os
+
+# Gunicorn configuration for production deployments: gunicorn -c gunicorn_conf.py main:app
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# gevent workers patch socket I/O, so each worker can wait on many OpenAI calls at once
+worker_class = 'gevent'
+worker_connections = 1000
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * (os.cpu_count() or 1) + 1))
+
+# Let the app split its client-side OpenAI rate limits across workers
+raw_env = [f'WEB_CONCURRENCY={workers}']
+
+# Generation waits on a chat completion plus DALL-E images, well past the 30s default
+timeout = 120
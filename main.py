@@ -1,23 +1,59 @@
-import json
+import atexit
+import logging
 import os
+import re
+import textwrap
 import uuid
 import csv
+import hashlib
 import io
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session, send_file
+from logging.handlers import QueueHandler, QueueListener
+import diskcache
+import httpx
+import orjson
+import redis
+from flask import Flask, Response, render_template, request, jsonify, flash, redirect, url_for, session, send_file, send_from_directory
+from flask_session import Session
 from werkzeug.utils import secure_filename
-from openai import OpenAI
+from openai import DefaultHttpxClient, OpenAI
+
+# Log through a queue so request threads never block on stream I/O
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+# The QueueHandler has no formatter of its own, so records are only formatted once (by
+# log_handler). WARNING keeps library INFO logs out, e.g. httpx logging signed image URLs.
+root_logger = logging.getLogger()
+root_logger.addHandler(QueueHandler(log_queue))
+root_logger.setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 # OpenAI model configuration with fallback
-OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o")
+OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
 app = Flask(__name__)
 app.secret_key = os.environ.get('SESSION_SECRET', 'dev-secret-key')
 
+# Store session data server-side in Redis; the cookie only carries the session id
+app.config['SESSION_TYPE'] = 'redis'
+app.config['SESSION_REDIS'] = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379'))
+Session(app)
+
 # Configure file uploads
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = '/tmp/uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
+# Hashtags (lowercase) that count as a local Berlin tag
+BERLIN_TAGS = frozenset({'berlineats', 'mitte', 'kreuzberg', 'berlinfoodie', 'berlin'})
+
 # Create upload directory if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
@@ -25,7 +61,144 @@ os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable is required")
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# Shared HTTP/2 connection pool for OpenAI calls and image downloads; concurrent
+# DALL-E requests are multiplexed over a few TLS connections instead of one each
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+http_client = DefaultHttpxClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+    timeout=HTTP_TIMEOUT
+)
+openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=http_client, timeout=HTTP_TIMEOUT)
+
+# Maximum number of concurrent DALL-E requests per generation
+MAX_IMAGE_WORKERS = 8
+
+# Batch API jobs: menus are separated by a line containing only "---"
+MAX_BATCH_MENUS = 50
+BATCH_MENU_SEPARATOR = re.compile(r'^\s*---\s*$', re.MULTILINE)
+BATCH_FINAL_STATUSES = {'completed', 'expired', 'cancelled', 'failed'}
+
+# Chat requests arriving within this window (seconds) are combined into one completion.
+# Opt-in, and only used once less than COALESCE_BELOW of the per-minute chat request
+# budget is left: combined prompts are slower and mix different users' menus.
+COALESCE_ENABLED = os.environ.get("OPENAI_CHAT_COALESCE", "").lower() in ("1", "true", "yes")
+COALESCE_BELOW = 0.1
+COALESCE_WINDOW = 0.05
+COALESCE_MAX_MENUS = 8
+# A combined completion is kept under this budget; larger requests are sent on their own
+COALESCE_MAX_TOKENS = 8000
+
+# Invariant instructions for post generation, built once and sent unchanged ahead of the
+# menu-specific prompt. At roughly 500 tokens this is below the 1024-token minimum for
+# OpenAI prompt caching, so it only saves rebuilding the string on every request.
+POSTS_SYSTEM_PROMPT = textwrap.dedent("""\
+    You are a social media expert specializing in restaurant marketing. Create engaging, authentic Instagram posts that highlight menu items and encourage restaurant visits. Always respond with valid JSON in the exact format requested.
+    
+    Each post should be appealing, include relevant hashtags, and encourage people to visit the restaurant.
+    Make each post unique and focus on different menu items or aspects of the restaurant.
+    
+    HASHTAG REQUIREMENTS:
+    - Include 1-2 local Berlin hashtags based on menu content (e.g., #Mitte for central location, #Kreuzberg for trendy area, #BerlinEats, #BerlinFoodie)
+    - Limit total hashtags to exactly 3 per post
+    - Make hashtags relevant to the specific dish and Berlin location
+    
+    IMAGE PROMPT REQUIREMENTS:
+    - Style: "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss"
+    - Make each image prompt specific to the actual menu item mentioned
+    
+    Please respond with a JSON object in this format:
+    {
+        "posts": [
+            {
+                "caption": "The main post text with emojis and engaging content",
+                "caption_german": "German translation (empty string unless language is 'both')",
+                "hashtags": ["hashtag1", "hashtag2", "BerlinHashtag"],
+                "image_prompt": "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss, showing [specific dish from menu]",
+                "variant": "casual/professional (empty string unless ab_test_mode is true)"
+            },
+            {
+                "caption": "Another unique post about different menu items",
+                "caption_german": "German translation (empty string unless language is 'both')",
+                "hashtags": ["hashtag1", "hashtag2", "BerlinHashtag"],
+                "image_prompt": "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss, showing [specific dish from menu]",
+                "variant": "casual/professional (empty string unless ab_test_mode is true)"
+            }
+        ]
+    }""")
+
+# Structured output schemas: the response is validated against these server-side.
+# Kept static (no per-request counts) so OpenAI can reuse the compiled schema.
+POSTS_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "posts": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "caption": {"type": "string"},
+                    "caption_german": {"type": "string"},
+                    "hashtags": {"type": "array", "items": {"type": "string"}, "minItems": 3, "maxItems": 3},
+                    "image_prompt": {"type": "string"},
+                    "variant": {"type": "string"}
+                },
+                "required": ["caption", "caption_german", "hashtags", "image_prompt", "variant"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["posts"],
+    "additionalProperties": False
+}
+COMBINED_POSTS_RESULT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "menus": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "menu_id": {"type": "integer"},
+                    "posts": POSTS_RESULT_SCHEMA["properties"]["posts"]
+                },
+                "required": ["menu_id", "posts"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["menus"],
+    "additionalProperties": False
+}
+
+# Image prompt for padding posts; shared by every fallback post, so its images aren't cached
+FALLBACK_IMAGE_PROMPT = "Professional food photography of restaurant dish, appetizing and well-plated"
+
+# Completion budget per generated post; German text takes noticeably more tokens than
+# English, so German and bilingual posts get the larger budget
+TOKENS_PER_POST = 160
+TOKENS_PER_POST_GERMAN = 240
+MAX_COMPLETION_TOKENS = 16000
+# Chat timeouts scale with max_tokens, assuming a conservative generation speed
+CHAT_TIMEOUT_BASE = 15.0
+CHAT_MIN_TOKENS_PER_SECOND = 40
+
+# Client-side rate limits, kept below the account's OpenAI limits to avoid 429 retries.
+# Each server worker process enforces its share of the account-wide limits.
+WORKER_COUNT = max(int(os.environ.get("WEB_CONCURRENCY", 1)), 1)
+OPENAI_CHAT_RPM = max(int(os.environ.get("OPENAI_CHAT_RPM", 3000)) // WORKER_COUNT, 1)
+OPENAI_CHAT_TPM = max(int(os.environ.get("OPENAI_CHAT_TPM", 450000)) // WORKER_COUNT, 1)
+OPENAI_IMAGE_IPM = max(int(os.environ.get("OPENAI_IMAGE_IPM", 500)) // WORKER_COUNT, 1)
+
+# Cache chat results and generated images so identical requests skip the API
+ai_cache = diskcache.Cache('/tmp/ai-cache')
+CACHE_EXPIRE = 7 * 86400
+# Part of the chat cache key; bump whenever the prompt or response schema changes
+PROMPT_VERSION = 1
+# Local copies of DALL-E images are deleted once they outlive their cache entry
+GENERATED_IMAGE_PREFIX = 'generated-'
+GENERATED_IMAGE_PRUNE_INTERVAL = 3600
 
 @app.route('/')
 def index():
@@ -53,37 +226,42 @@ def generate_posts():
         # Get A/B test mode preference
         ab_test_mode = request.form.get('ab_test_mode') == 'on'
         
+        # Posts that already have an uploaded image don't need a generated one
+        skip_images = {int(index) for index in session.get('uploaded_images', {})}
+        
         # Generate posts using OpenAI (optimized single call)
-        posts = generate_multiple_social_media_posts(menu_text, num_posts, language, ab_test_mode)
+        posts = generate_multiple_social_media_posts(menu_text, num_posts, language, ab_test_mode, skip_images)
         
         if not posts:
             flash('Failed to generate posts. Please try again.', 'error')
             return redirect(url_for('index'))
         
-        # Merge uploaded images into posts for export
-        uploaded_images = session.get('uploaded_images', {})
-        for i, post in enumerate(posts):
-            if str(i) in uploaded_images:
-                post['image_url'] = f'/uploaded_image/{uploaded_images[str(i)]}'
-        
         # Store posts in session for potential exports
         session['current_posts'] = posts
         session['current_menu_text'] = menu_text
         session['current_language'] = language
         
-        return render_template('results.html', posts=posts, menu_text=menu_text, language=language, ab_test_mode=ab_test_mode)
+        return render_template('results.html', posts=with_uploaded_images(posts), menu_text=menu_text, language=language, ab_test_mode=ab_test_mode)
     
     except ValueError:
         flash('Invalid number of posts. Please enter a valid number.', 'error')
         return redirect(url_for('index'))
-    except Exception as e:
-        print(f"Error generating posts: {e}")
+    except Exception:
+        logger.exception("Error generating posts")
         flash('Sorry, we encountered an issue generating your posts. Please try again.', 'error')
         return redirect(url_for('index'))
 
-def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def with_uploaded_images(posts):
+    """Return posts with image URLs replaced by any images the user uploaded"""
+    uploaded_images = session.get('uploaded_images', {})
+    return [
+        {**post, 'image_url': f'/uploaded_image/{uploaded_images[str(i)]}'} if str(i) in uploaded_images else post
+        for i, post in enumerate(posts)
+    ]
+
+def file_extension(filename):
+    """Return the lowercase file extension, or an empty string if there is none"""
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
 
 @app.route('/upload_image/<int:post_index>', methods=['POST'])
 def upload_image(post_index):
@@ -92,72 +270,71 @@ def upload_image(post_index):
         return jsonify({'error': 'No file selected'}), 400
     
     file = request.files['image']
-    if file.filename == '':
+    if not file.filename:
         return jsonify({'error': 'No file selected'}), 400
     
-    if file and file.filename and allowed_file(file.filename):
-        # Generate unique filename
-        filename = str(uuid.uuid4()) + '.' + file.filename.rsplit('.', 1)[1].lower()
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Store in session for this post
-        if 'uploaded_images' not in session:
-            session['uploaded_images'] = {}
-        session['uploaded_images'][str(post_index)] = filename
-        
-        # Also update the current posts if available
-        if 'current_posts' in session and len(session['current_posts']) > post_index:
-            session['current_posts'][post_index]['image_url'] = f'/uploaded_image/{filename}'
-        
-        session.modified = True
-        
-        return jsonify({'success': True, 'filename': filename, 'url': f'/uploaded_image/{filename}'})
+    extension = file_extension(file.filename)
+    if extension not in ALLOWED_EXTENSIONS:
+        return jsonify({'error': 'Invalid file type'}), 400
     
-    return jsonify({'error': 'Invalid file type'}), 400
+    # Generate unique filename
+    filename = f'{uuid.uuid4().hex}.{extension}'
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(filepath, buffer_size=64 * 1024)
+    
+    # Store in session for this post; posts pick it up when they are read
+    if 'uploaded_images' not in session:
+        session['uploaded_images'] = {}
+    session['uploaded_images'][str(post_index)] = filename
+    session.modified = True
+    
+    return jsonify({'success': True, 'filename': filename, 'url': f'/uploaded_image/{filename}'})
 
 @app.route('/uploaded_image/<filename>')
 def uploaded_image(filename):
     """Serve uploaded images"""
-    return send_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+    # Filenames are unique per image, so browsers can cache them indefinitely
+    return send_from_directory(app.config['UPLOAD_FOLDER'], secure_filename(filename), conditional=True, max_age=31536000)
 
 @app.route('/export_posts')
 def export_posts():
     """Export all posts as JSON or CSV"""
     format_type = request.args.get('format', 'json')
-    posts = session.get('current_posts', [])
+    posts = with_uploaded_images(session.get('current_posts', []))
     
     if not posts:
         flash('No posts to export. Please generate posts first.', 'error')
         return redirect(url_for('index'))
     
     if format_type == 'csv':
-        # Create CSV export
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        headers = ['Post_Index', 'Caption_EN', 'Caption_DE', 'Hashtags', 'Image_URL', 'Image_Prompt']
-        writer.writerow(headers)
-        
-        # Write data
-        for i, post in enumerate(posts):
-            print("Generating post", i)
-            writer.writerow([
-                i + 1,
-                post.get('caption', ''),
-                post.get('caption_german', ''),
-                ', '.join(post.get('hashtags', [])),
-                post.get('image_url', ''),
-                post.get('image_prompt', '')
-            ])
+        # Stream the CSV export row by row
+        def generate_csv():
+            output = io.StringIO()
+            writer = csv.writer(output)
+            
+            # Write header
+            headers = ['Post_Index', 'Caption_EN', 'Caption_DE', 'Hashtags', 'Image_URL', 'Image_Prompt']
+            writer.writerow(headers)
+            yield output.getvalue()
+            
+            # Write data
+            for i, post in enumerate(posts):
+                output.seek(0)
+                output.truncate()
+                writer.writerow([
+                    i + 1,
+                    post.get('caption', ''),
+                    post.get('caption_german', ''),
+                    ', '.join(post.get('hashtags', [])),
+                    post.get('image_url', ''),
+                    post.get('image_prompt', '')
+                ])
+                yield output.getvalue()
         
-        output.seek(0)
-        return send_file(
-            io.BytesIO(output.getvalue().encode()),
+        return Response(
+            generate_csv(),
             mimetype='text/csv',
-            as_attachment=True,
-            download_name='social_media_posts.csv'
+            headers={'Content-Disposition': 'attachment; filename=social_media_posts.csv'}
         )
     else:
         # JSON export
@@ -169,191 +346,492 @@ def export_posts():
         }
         
         return send_file(
-            io.BytesIO(json.dumps(export_data, indent=2).encode()),
+            io.BytesIO(orjson.dumps(export_data, option=orjson.OPT_INDENT_2)),
             mimetype='application/json',
             as_attachment=True,
             download_name='social_media_posts.json'
         )
 
-def generate_multiple_social_media_posts(menu_text, num_posts, language='english', ab_test_mode=False):
-    """Generate multiple Instagram-style social media posts in a single API call"""
+@app.route('/generate_batch', methods=['POST'])
+def generate_batch():
+    """Submit several menus as a single OpenAI Batch API job"""
     try:
-        # Determine language instructions
-        if language == 'german':
-            lang_instruction = "Create posts in German language."
-        elif language == 'both':
-            lang_instruction = "Create posts in English first, then provide German translations."
-        else:
-            lang_instruction = "Create posts in English."
-
-        # A/B test variants instruction
-        variant_instruction = ""
-        actual_posts_needed = num_posts
-        if ab_test_mode:
-            variant_instruction = " For each post concept, create TWO variants - one casual tone and one professional tone. This will result in pairs of posts for A/B testing."
-            actual_posts_needed = num_posts * 2  # Double the posts for A/B variants
-        
-        prompt = f"""
-        Based on the following restaurant menu, create {actual_posts_needed} engaging Instagram-style social media posts. 
-        Each post should be appealing, include relevant hashtags, and encourage people to visit the restaurant.
-        Make each post unique and focus on different menu items or aspects of the restaurant.
-        {lang_instruction}{variant_instruction}
-        
-        HASHTAG REQUIREMENTS:
-        - Include 1-2 local Berlin hashtags based on menu content (e.g., #Mitte for central location, #Kreuzberg for trendy area, #BerlinEats, #BerlinFoodie)
-        - Limit total hashtags to exactly 3 per post
-        - Make hashtags relevant to the specific dish and Berlin location
+        # Get form data
+        menu_texts = [menu.strip() for menu in BATCH_MENU_SEPARATOR.split(request.form.get('menu_texts', ''))]
+        menu_texts = [menu for menu in menu_texts if menu]
+        num_posts = int(request.form.get('num_posts', 3))
+        language = request.form.get('language', 'english')
+        ab_test_mode = request.form.get('ab_test_mode') == 'on'
         
-        IMAGE PROMPT REQUIREMENTS:
-        - Style: "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss"
-        - Make each image prompt specific to the actual menu item mentioned
+        # Validate input
+        if not menu_texts:
+            flash('Please enter at least one restaurant menu.', 'error')
+            return redirect(url_for('index'))
         
-        Menu: {menu_text}
+        if len(menu_texts) > MAX_BATCH_MENUS:
+            flash(f'A batch can contain at most {MAX_BATCH_MENUS} menus.', 'error')
+            return redirect(url_for('index'))
         
-        Please respond with a JSON object in this format:
-        {{
-            "posts": [
-                {{
-                    "caption": "The main post text with emojis and engaging content",
-                    "caption_german": "German translation (only if language is 'both')",
-                    "hashtags": ["hashtag1", "hashtag2", "BerlinHashtag"],
-                    "image_prompt": "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss, showing [specific dish from menu]",
-                    "variant": "casual/professional (only if ab_test_mode is true)"
-                }},
-                {{
-                    "caption": "Another unique post about different menu items",
-                    "caption_german": "German translation (only if language is 'both')",
-                    "hashtags": ["hashtag1", "hashtag2", "BerlinHashtag"],
-                    "image_prompt": "Photorealistic casual food photo, smartphone-style, natural lighting in Berlin bistro—no studio gloss, showing [specific dish from menu]",
-                    "variant": "casual/professional (only if ab_test_mode is true)"
-                }}
-            ]
-        }}
+        if num_posts < 1 or num_posts > 10:
+            flash('Number of posts must be between 1 and 10.', 'error')
+            return redirect(url_for('index'))
         
-        Generate exactly {actual_posts_needed} posts in the array. Always include exactly 3 hashtags with Berlin location tags.
-        """
+        # One chat completion request per menu
+        lines = []
+        actual_posts_needed = num_posts
+        for i, menu_text in enumerate(menu_texts):
+            body, actual_posts_needed = build_posts_request([menu_text], num_posts, language, ab_test_mode)
+            lines.append(orjson.dumps({
+                "custom_id": f"menu-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body
+            }))
         
-        response = openai_client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are a social media expert specializing in restaurant marketing. Create engaging, authentic Instagram posts that highlight menu items and encourage restaurant visits. Always respond with valid JSON in the exact format requested."
-                },
-                {"role": "user", "content": prompt}
-            ],
-            response_format={"type": "json_object"},
-            timeout=30,
-            max_tokens=2000
+        batch_file = openai_client.files.create(
+            file=('menus.jsonl', b'\n'.join(lines)),
+            purpose='batch'
+        )
+        batch = openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window='24h',
+            metadata={'language': language, 'posts_needed': str(actual_posts_needed)}
         )
         
-        content = response.choices[0].message.content
-        if content is None:
-            raise ValueError("Empty response from OpenAI")
+        session['batch_id'] = batch.id
+        return redirect(url_for('batch_status'))
+    
+    except ValueError:
+        flash('Invalid number of posts. Please enter a valid number.', 'error')
+        return redirect(url_for('index'))
+    except Exception:
+        logger.exception("Error submitting batch")
+        flash('Sorry, we encountered an issue submitting your batch. Please try again.', 'error')
+        return redirect(url_for('index'))
+
+@app.route('/batch_status')
+def batch_status():
+    """Show the status of the current batch job and its posts once completed"""
+    batch_id = session.get('batch_id')
+    if not batch_id:
+        flash('No batch job found. Please submit a batch first.', 'error')
+        return redirect(url_for('index'))
+    
+    try:
+        batch = openai_client.batches.retrieve(batch_id)
+        metadata = batch.metadata or {}
+        language = metadata.get('language', 'english')
         
-        result = json.loads(content)
-        posts_data = result.get("posts", [])
+        results = []
+        if batch.status in BATCH_FINAL_STATUSES:
+            # A finished batch never changes, so its parsed results are cached
+            cache_key = cache_key_for('batch', batch.id)
+            results = ai_cache.get(cache_key)
+            if results is None:
+                results = load_batch_results(batch, int(metadata.get('posts_needed', 3)), language)
+                ai_cache.set(cache_key, results, expire=CACHE_EXPIRE)
         
-        # Validate and clean the posts
-        posts = []
-        for i, post_data in enumerate(posts_data):
-            if isinstance(post_data, dict) and "caption" in post_data:
-                # Ensure hashtags are strings and normalize them
-                hashtags = post_data.get("hashtags", [])
-                if isinstance(hashtags, list):
-                    # Normalize hashtags: remove # prefix, limit to 3, ensure Berlin tags
-                    normalized_tags = []
-                    for tag in hashtags:
-                        if tag:
-                            clean_tag = str(tag).strip().lstrip('#')
-                            if clean_tag:
-                                normalized_tags.append(clean_tag)
-                    
-                    # Ensure we have Berlin-specific hashtags (case-insensitive)
-                    berlin_tags = ['berlineats', 'mitte', 'kreuzberg', 'berlinfoodie', 'berlin']
-                    has_berlin_tag = any(tag.lower() in berlin_tags for tag in normalized_tags)
-                    
-                    # If no Berlin tag, replace last tag with a Berlin tag or add one
-                    if not has_berlin_tag:
-                        if len(normalized_tags) >= 3:
-                            # Replace the last tag with a Berlin tag
-                            normalized_tags[-1] = 'BerlinEats'
-                        else:
-                            # Add a Berlin tag
-                            normalized_tags.append('BerlinEats')
-                    
-                    # Ensure exactly 3 hashtags
-                    hashtags = normalized_tags[:3]
-                    while len(hashtags) < 3:
-                        if 'foodie' not in [tag.lower() for tag in hashtags]:
-                            hashtags.append('foodie')
-                        elif 'delicious' not in [tag.lower() for tag in hashtags]:
-                            hashtags.append('delicious')
-                        else:
-                            hashtags.append('restaurant')
-                else:
-                    hashtags = ['BerlinEats', 'foodie', 'delicious']
-                
-                # Generate image using DALL-E
-                image_url = None
-                image_prompt = post_data.get("image_prompt", "")
-                if image_prompt:
-                    try:
-                        image_url = generate_food_image(image_prompt)
-                    except Exception as e:
-                        print(f"Error generating image for post {i+1}: {e}")
+        return render_template('batch_status.html', batch=batch, results=results, language=language)
+    
+    except Exception:
+        logger.exception("Error checking batch status")
+        flash('Sorry, we encountered an issue checking your batch. Please try again.', 'error')
+        return redirect(url_for('index'))
+
+def load_batch_results(batch, posts_needed, language='english'):
+    """Download a finished batch's output and error files and parse them into per-menu results"""
+    results = []
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        
+        for line in openai_client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            menu_index = int(item['custom_id'].rsplit('-', 1)[1])
+            response = item.get('response') or {}
+            try:
+                if response.get('status_code') != 200:
+                    error = item.get('error') or {}
+                    raise ValueError(error.get('message') or f"Request failed with status {response.get('status_code')}")
+                choice = response['body']['choices'][0]
+                if choice.get('finish_reason') == 'length':
+                    raise ValueError("Response was cut off at max_tokens")
+                content = choice['message']['content']
+                posts = parse_posts(content, posts_needed, language)
+                results.append({'menu_index': menu_index, 'posts': posts, 'error': None})
+            except (KeyError, IndexError, ValueError) as e:
+                logger.warning("Error parsing batch result for menu %d: %s", menu_index + 1, e)
+                results.append({'menu_index': menu_index, 'posts': [], 'error': 'Failed to generate posts for this menu.'})
+    
+    results.sort(key=lambda result: result['menu_index'])
+    return results
+
+def completion_token_budget(num_posts, language='english', ab_test_mode=False, menu_count=1):
+    """Estimate the completion tokens needed to generate posts for menu_count menus"""
+    tokens_per_post = TOKENS_PER_POST_GERMAN if language in ('german', 'both') else TOKENS_PER_POST
+    actual_posts_needed = num_posts * 2 if ab_test_mode else num_posts
+    return 100 + tokens_per_post * actual_posts_needed * menu_count
+
+def build_posts_request(menu_texts, num_posts, language='english', ab_test_mode=False):
+    """Build the chat completion request body for one or more menus, plus the number of posts per menu"""
+    # Determine language instructions
+    if language == 'german':
+        lang_instruction = "Create posts in German language."
+    elif language == 'both':
+        lang_instruction = "Create posts in English first, then provide German translations."
+    else:
+        lang_instruction = "Create posts in English."
+
+    # A/B test variants instruction
+    variant_instruction = ""
+    actual_posts_needed = num_posts
+    if ab_test_mode:
+        variant_instruction = " For each post concept, create TWO variants - one casual tone and one professional tone. This will result in pairs of posts for A/B testing."
+        actual_posts_needed = num_posts * 2  # Double the posts for A/B variants
+    
+    if len(menu_texts) == 1:
+        prompt = (
+            f"Based on the following restaurant menu, create {actual_posts_needed} engaging Instagram-style social media posts.\n"
+            f"{lang_instruction}{variant_instruction}\n\n"
+            f"Menu: {menu_texts[0]}\n\n"
+            f"Generate exactly {actual_posts_needed} posts in the array. Always include exactly 3 hashtags with Berlin location tags."
+        )
+    else:
+        # Several menus share the instructions and are answered in a single response
+        menus_section = "\n".join(f"---MENU {i}---\n{menu_text}" for i, menu_text in enumerate(menu_texts, 1))
+        prompt = (
+            f"For each of the following {len(menu_texts)} restaurant menus separately, create {actual_posts_needed} engaging Instagram-style social media posts.\n"
+            f"{lang_instruction}{variant_instruction}\n\n"
+            f"Menus:\n{menus_section}\n\n"
+            'Respond with a JSON object containing a "menus" array with one element per menu. '
+            'Each element must be a JSON object in the format described above, plus a "menu_id" field '
+            "set to the number of the menu it was written for (e.g. 1 for ---MENU 1---).\n"
+            f'Generate exactly {len(menu_texts)} elements in the "menus" array, each with exactly {actual_posts_needed} posts. '
+            "Always include exactly 3 hashtags with Berlin location tags."
+        )
+    
+    # Size the completion budget to the expected output instead of a fixed ceiling
+    max_tokens = min(completion_token_budget(num_posts, language, ab_test_mode, len(menu_texts)), MAX_COMPLETION_TOKENS)
+    
+    body = {
+        "model": OPENAI_MODEL,
+        "messages": [
+            {"role": "system", "content": POSTS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": "social_media_posts" if len(menu_texts) == 1 else "social_media_posts_by_menu",
+                "schema": POSTS_RESULT_SCHEMA if len(menu_texts) == 1 else COMBINED_POSTS_RESULT_SCHEMA,
+                "strict": True
+            }
+        },
+        "max_tokens": max_tokens,
+        "temperature": 0.7
+    }
+    return body, actual_posts_needed
+
+def parse_posts(content, actual_posts_needed, language='english'):
+    """Parse a chat completion JSON response into cleaned, padded posts (without images)"""
+    if content is None:
+        raise ValueError("Empty response from OpenAI")
+    
+    return clean_posts(orjson.loads(content), actual_posts_needed, language)
+
+def clean_posts(result, actual_posts_needed, language='english'):
+    """Validate, normalize and pad the posts of a single menu result (without images)"""
+    posts_data = result.get("posts", [])
+    
+    # Validate and clean the posts
+    posts = []
+    for post_data in posts_data:
+        if isinstance(post_data, dict) and "caption" in post_data:
+            # Ensure hashtags are strings and normalize them
+            hashtags = post_data.get("hashtags", [])
+            if isinstance(hashtags, list):
+                # Normalize hashtags: remove # prefix, limit to 3, ensure Berlin tags
+                normalized_tags = []
+                lower_tags = set()
+                for tag in hashtags:
+                    if tag:
+                        clean_tag = str(tag).strip().lstrip('#')
+                        if clean_tag:
+                            normalized_tags.append(clean_tag)
+                            lower_tags.add(clean_tag.lower())
                 
-                post = {
-                    "caption": str(post_data.get("caption", "")),
-                    "hashtags": hashtags,
-                    "image_url": image_url,
-                    "image_prompt": image_prompt,
-                    "variant": post_data.get("variant", ""),
-                    "post_id": str(uuid.uuid4())  # Unique ID for A/B tracking
-                }
+                # Ensure we have Berlin-specific hashtags (case-insensitive)
+                has_berlin_tag = not lower_tags.isdisjoint(BERLIN_TAGS)
                 
-                # Add German translation if available
-                if language == 'both' and post_data.get("caption_german"):
-                    post["caption_german"] = str(post_data.get("caption_german", ""))
+                # If no Berlin tag, replace last tag with a Berlin tag or add one
+                if not has_berlin_tag:
+                    if len(normalized_tags) >= 3:
+                        # Replace the last tag with a Berlin tag
+                        normalized_tags[-1] = 'BerlinEats'
+                    else:
+                        # Add a Berlin tag
+                        normalized_tags.append('BerlinEats')
                 
-                posts.append(post)
-        
-        # Ensure we have the requested number of posts (pad or slice as needed)
-        while len(posts) < actual_posts_needed:
-            default_prompt = "Professional food photography of restaurant dish, appetizing and well-plated"
-            default_image = None
-            try:
-                default_image = generate_food_image(default_prompt)
-            except Exception:
-                pass
+                # Ensure exactly 3 hashtags (padding only happens when there were fewer than 3,
+                # so lower_tags still matches the kept tags)
+                hashtags = normalized_tags[:3]
+                while len(hashtags) < 3:
+                    if 'foodie' not in lower_tags:
+                        filler_tag = 'foodie'
+                    elif 'delicious' not in lower_tags:
+                        filler_tag = 'delicious'
+                    else:
+                        filler_tag = 'restaurant'
+                    hashtags.append(filler_tag)
+                    lower_tags.add(filler_tag)
+            else:
+                hashtags = ['BerlinEats', 'foodie', 'delicious']
             
-            fallback_post = {
-                "caption": "Check out our amazing menu! Come visit us today! 🍴✨",
-                "hashtags": ["BerlinEats", "foodie", "Mitte"],
-                "image_url": default_image,
-                "image_prompt": default_prompt,
-                "variant": "casual",
-                "post_id": str(uuid.uuid4())
+            image_prompt = post_data.get("image_prompt", "")
+            
+            post = {
+                "caption": str(post_data.get("caption", "")),
+                "hashtags": hashtags,
+                "image_url": None,
+                "image_prompt": image_prompt,
+                "variant": post_data.get("variant", ""),
+                "post_id": str(uuid.uuid4())  # Unique ID for A/B tracking
             }
             
-            if language == 'both':
-                fallback_post["caption_german"] = "Schaut euch unser fantastisches Menü an! Besucht uns heute! 🍴✨"
+            # Add German translation if available
+            if language == 'both' and post_data.get("caption_german"):
+                post["caption_german"] = str(post_data.get("caption_german", ""))
             
-            posts.append(fallback_post)
+            posts.append(post)
+    
+    # Ensure we have the requested number of posts (pad or slice as needed)
+    posts = posts[:actual_posts_needed]
+    while len(posts) < actual_posts_needed:
+        fallback_post = {
+            "caption": "Check out our amazing menu! Come visit us today! 🍴✨",
+            "hashtags": ["BerlinEats", "foodie", "Mitte"],
+            "image_url": None,
+            "image_prompt": FALLBACK_IMAGE_PROMPT,
+            "variant": "casual",
+            "post_id": str(uuid.uuid4())
+        }
+        
+        if language == 'both':
+            fallback_post["caption_german"] = "Schaut euch unser fantastisches Menü an! Besucht uns heute! 🍴✨"
         
-        return posts[:actual_posts_needed]
+        posts.append(fallback_post)
+    
+    return posts
+
+class RateLimiter:
+    """Thread-safe token bucket admitting up to max_rate units per time_period seconds"""
     
-    except json.JSONDecodeError as e:
-        print(f"JSON parsing error: {e}")
+    def __init__(self, max_rate, time_period=60):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._level = max_rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.max_rate, self._level + (now - self._updated) * self.max_rate / self.time_period)
+        self._updated = now
+    
+    def available(self):
+        """Return the number of units that could be acquired right now"""
+        with self._lock:
+            self._refill()
+            return self._level
+    
+    def acquire(self, amount=1):
+        """Block until amount units are available, then consume them"""
+        amount = min(amount, self.max_rate)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                wait = (amount - self._level) * self.time_period / self.max_rate
+            time.sleep(wait)
+
+chat_request_limiter = RateLimiter(OPENAI_CHAT_RPM)
+chat_token_limiter = RateLimiter(OPENAI_CHAT_TPM)
+image_limiter = RateLimiter(OPENAI_IMAGE_IPM)
+
+def cache_key_for(*parts):
+    """Build a content-addressed cache key from the request parameters"""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+def estimate_tokens(body):
+    """Estimate the tokens a chat request counts against the TPM limit"""
+    # OpenAI counts roughly 4 characters per prompt token plus the full max_tokens budget
+    prompt_chars = sum(len(message["content"]) for message in body["messages"])
+    return prompt_chars // 4 + body["max_tokens"]
+
+def request_posts_completion(body):
+    """Send a chat completion request within the rate limits and return the parsed JSON result"""
+    chat_request_limiter.acquire()
+    chat_token_limiter.acquire(estimate_tokens(body))
+    # Generation time grows with the completion size, so the timeout does too
+    timeout = CHAT_TIMEOUT_BASE + body["max_tokens"] / CHAT_MIN_TOKENS_PER_SECOND
+    response = openai_client.chat.completions.create(**body, timeout=timeout)
+    
+    if response.choices[0].finish_reason == "length":
+        raise ValueError("Response from OpenAI was cut off at max_tokens")
+    content = response.choices[0].message.content
+    if content is None:
+        raise ValueError("Empty response from OpenAI")
+    return orjson.loads(content)
+
+class ChatCoalescer:
+    """Combine chat requests that arrive close together into a single chat completion"""
+    
+    def __init__(self, window=COALESCE_WINDOW, max_menus=COALESCE_MAX_MENUS):
+        self.window = window
+        self.max_menus = max_menus
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._collector = None
+    
+    def submit(self, menu_text, num_posts, language='english', ab_test_mode=False):
+        """Queue a menu and return a Future resolving to (result, combined), where result is
+        {"posts": [...]} and combined tells whether it came from a shared completion"""
+        future = Future()
+        self._ensure_collector()
+        self._queue.put(((num_posts, language, ab_test_mode), menu_text, future))
+        return future
+    
+    def _ensure_collector(self):
+        # Started lazily so the thread lives in the serving process (e.g. after a gunicorn fork)
+        with self._lock:
+            if self._collector is None or not self._collector.is_alive():
+                self._collector = threading.Thread(target=self._collect, daemon=True)
+                self._collector.start()
+    
+    def _collect(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(pending) < self.max_menus:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            # Only menus with identical options can share a prompt
+            groups = {}
+            for options, menu_text, future in pending:
+                groups.setdefault(options, []).append((menu_text, future))
+            # One thread per completion: concurrency is bounded by the rate limiters, not a pool
+            for options, requests in groups.items():
+                group_size = self._group_size(options)
+                for start in range(0, len(requests), group_size):
+                    chunk = requests[start:start + group_size]
+                    threading.Thread(target=self._complete, args=(options, chunk), daemon=True).start()
+    
+    def _group_size(self, options):
+        # Largest number of menus whose combined output fits the completion budget
+        group_size = self.max_menus
+        while group_size > 1 and completion_token_budget(*options, menu_count=group_size) > COALESCE_MAX_TOKENS:
+            group_size -= 1
+        return group_size
+    
+    def _complete(self, options, requests):
+        if len(requests) == 1:
+            self._complete_single(options, requests[0])
+            return
+        
+        num_posts, language, ab_test_mode = options
+        menu_texts = [menu_text for menu_text, _ in requests]
+        try:
+            body, _ = build_posts_request(menu_texts, num_posts, language, ab_test_mode)
+            result = request_posts_completion(body)
+            
+            # Match results to menus by id, never by position; a missing or duplicated id
+            # leaves that request unanswered rather than handing it another user's posts
+            menu_results = {}
+            duplicate_ids = set()
+            for menu_result in result.get("menus", []):
+                menu_id = menu_result.get("menu_id") if isinstance(menu_result, dict) else None
+                if menu_id in menu_results:
+                    duplicate_ids.add(menu_id)
+                menu_results[menu_id] = menu_result
+            
+            for menu_id, (_, future) in enumerate(requests, 1):
+                if menu_id in menu_results and menu_id not in duplicate_ids:
+                    future.set_result(({"posts": menu_results[menu_id].get("posts", [])}, True))
+        except Exception:
+            logger.warning("Combined chat completion failed", exc_info=True)
+        
+        # One refusal or malformed reply shouldn't fail every caller; retry the rest on their own
+        for menu_request in requests:
+            if not menu_request[1].done():
+                threading.Thread(target=self._complete_single, args=(options, menu_request), daemon=True).start()
+    
+    def _complete_single(self, options, menu_request):
+        menu_text, future = menu_request
+        try:
+            body, _ = build_posts_request([menu_text], *options)
+            future.set_result((request_posts_completion(body), False))
+        except Exception as e:
+            future.set_exception(e)
+
+chat_coalescer = ChatCoalescer()
+
+def should_coalesce_chat():
+    """Return whether chat requests should currently be combined into shared completions"""
+    return COALESCE_ENABLED and chat_request_limiter.available() < chat_request_limiter.max_rate * COALESCE_BELOW
+
+def generate_multiple_social_media_posts(menu_text, num_posts, language='english', ab_test_mode=False, skip_images=()):
+    """Generate multiple Instagram-style social media posts in a single API call"""
+    try:
+        actual_posts_needed = num_posts * 2 if ab_test_mode else num_posts
+        cache_key = cache_key_for(PROMPT_VERSION, OPENAI_MODEL, menu_text, num_posts, language, ab_test_mode)
+        result = ai_cache.get(cache_key)
+        if result is None:
+            if should_coalesce_chat():
+                result, combined = chat_coalescer.submit(menu_text, num_posts, language, ab_test_mode).result()
+            else:
+                body, _ = build_posts_request([menu_text], num_posts, language, ab_test_mode)
+                result, combined = request_posts_completion(body), False
+            # Short results get padded with fallback posts, and combined results were written
+            # alongside other users' menus; don't keep serving either
+            posts_data = result.get("posts", [])
+            if not combined and isinstance(posts_data, list) and len(posts_data) >= actual_posts_needed:
+                ai_cache.set(cache_key, result, expire=CACHE_EXPIRE)
+        posts = clean_posts(result, actual_posts_needed, language)
+        
+        # Generate all images using DALL-E in a single concurrent fan-out
+        if posts:
+            # Indices in skip_images already have an uploaded image, so no DALL-E call is made
+            prompts = [None if i in skip_images else post["image_prompt"] for i, post in enumerate(posts)]
+            with ThreadPoolExecutor(max_workers=min(len(prompts), MAX_IMAGE_WORKERS)) as executor:
+                image_urls = list(executor.map(_safe_generate_food_image, prompts))
+            for post, image_url in zip(posts, image_urls):
+                post["image_url"] = image_url
+        
+        return posts
+    
+    except orjson.JSONDecodeError:
+        logger.exception("JSON parsing error")
         raise ValueError("Invalid response format from AI service")
-    except Exception as e:
-        print(f"Error generating posts: {e}")
+    except Exception:
+        logger.exception("Error generating posts")
         raise ValueError("Failed to generate social media posts")
 
 def generate_food_image(prompt):
     """Generate food image using DALL-E 3"""
     try:
         # Reference from python_openai blueprint integration
+        image_limiter.acquire()
         response = openai_client.images.generate(
             model="dall-e-3",
             prompt=prompt,
@@ -367,9 +845,72 @@ def generate_food_image(prompt):
             raise ValueError("No image data returned from DALL-E")
             
     except Exception as e:
-        print(f"Error generating image: {e}")
+        logger.exception("Error generating image")
         raise e
 
+_last_image_prune = 0.0
+_image_prune_lock = threading.Lock()
+
+def prune_generated_images():
+    """Delete generated images older than the cache lifetime, at most once per prune interval"""
+    global _last_image_prune
+    with _image_prune_lock:
+        now = time.time()
+        if now - _last_image_prune < GENERATED_IMAGE_PRUNE_INTERVAL:
+            return
+        _last_image_prune = now
+    
+    cutoff = now - CACHE_EXPIRE
+    with os.scandir(app.config['UPLOAD_FOLDER']) as entries:
+        for entry in entries:
+            if not entry.name.startswith(GENERATED_IMAGE_PREFIX):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # Already removed by another worker
+                pass
+
+def save_remote_image(image_url):
+    """Download an image into the upload folder and return its filename"""
+    response = http_client.get(image_url)
+    response.raise_for_status()
+    
+    prune_generated_images()
+    filename = f'{GENERATED_IMAGE_PREFIX}{uuid.uuid4().hex}.png'
+    with open(os.path.join(app.config['UPLOAD_FOLDER'], filename), 'wb') as f:
+        f.write(response.content)
+    return filename
+
+def _safe_generate_food_image(prompt):
+    """Generate food image and host a local copy, returning None instead of raising on failure"""
+    if not prompt:
+        return None
+    
+    # Every fallback post uses the same prompt; give each its own image rather than a cached one
+    cache_key = cache_key_for("dall-e-3", prompt) if prompt != FALLBACK_IMAGE_PROMPT else None
+    filename = ai_cache.get(cache_key) if cache_key else None
+    if filename and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return f'/uploaded_image/{filename}'
+    
+    try:
+        image_url = generate_food_image(prompt)
+    except Exception:
+        return None
+    
+    # DALL-E URLs expire after about an hour, so keep our own copy
+    try:
+        filename = save_remote_image(image_url)
+    except Exception:
+        logger.exception("Error saving generated image")
+        return image_url
+    
+    if cache_key:
+        ai_cache.set(cache_key, filename, expire=CACHE_EXPIRE)
+    return f'/uploaded_image/{filename}'
+
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (see gunicorn_conf.py)
     # Use 0.0.0.0 to allow external connections in Replit
     app.run(debug=True, host='0.0.0.0', port=5000)